@@ -1,7 +1,7 @@
 import os
 import io
-import time
-import base64
+import hashlib
+import threading
 from concurrent.futures import ThreadPoolExecutor
 
 import streamlit as st
@@ -10,11 +10,29 @@ try:
     # python-docx is optional; install it if you want DOCX output
     from docx import Document as DocxDocument
     from docx.shared import Inches
+    from docx.image.image import Image as DocxImage
+    from docx.opc.constants import RELATIONSHIP_TYPE as RT
+    from docx.opc.packuri import PackURI
+    from docx.oxml import OxmlElement
+    from docx.oxml.ns import qn
+    from docx.oxml.shape import CT_Inline
+    from docx.parts.image import ImagePart
     HAS_PYTHON_DOCX = True
 except Exception:
     HAS_PYTHON_DOCX = False
 
-from mistralai import Mistral, DocumentURLChunk
+try:
+    # pybase64 is optional; a SIMD-accelerated drop-in for the stdlib base64 module
+    import pybase64
+
+    def b64decode(data) -> bytes:
+        # Input comes straight from the API's JSON, so skip alphabet validation
+        return pybase64.b64decode(data, validate=False)
+except Exception:
+    # binascii directly, skipping base64.b64decode's argument normalisation layer
+    from binascii import a2b_base64 as b64decode
+
+from mistralai import Mistral, DocumentURLChunk, OCRResponse
 
 # -----------------------------
 # Helpers
@@ -29,72 +47,252 @@ def get_api_key() -> str:
     return key 
 
 
-def pdf_bytes_to_data_url(pdf_bytes: bytes) -> str:
-    b64 = base64.b64encode(pdf_bytes).decode("utf-8")
-    return f"data:application/pdf;base64,{b64}"
+@st.cache_resource
+def get_client(api_key: str) -> Mistral:
+    """One Mistral client (and HTTP connection pool) per API key, reused across runs."""
+    return Mistral(api_key=api_key)
+
 
+def get_executor() -> ThreadPoolExecutor:
+    """Per-session background pool, created on first use and kept across reruns."""
+    if 'executor' not in st.session_state:
+        st.session_state.executor = ThreadPoolExecutor(max_workers=2)
+    return st.session_state.executor
 
-def run_ocr(client: Mistral, pdf_bytes: bytes, include_images: bool = True):
-    data_url = pdf_bytes_to_data_url(pdf_bytes)
-    return client.ocr.process(
-        model="mistral-ocr-latest",
-        document=DocumentURLChunk(document_url=data_url),
-        include_image_base64=include_images,
+
+def run_ocr(client: Mistral, pdf_bytes: bytes, include_images: bool = False):
+    """Upload the PDF to Mistral Files and OCR it via a signed URL (no base64 inlining).
+
+    Extracted images only come back as inline base64 (the API has no image URLs),
+    which inflates the response by about a third, so callers opt in explicitly.
+    """
+    uploaded = client.files.upload(
+        file={"file_name": "input.pdf", "content": pdf_bytes},
+        purpose="ocr",
     )
+    try:
+        signed = client.files.get_signed_url(file_id=uploaded.id)
+        return client.ocr.process(
+            model="mistral-ocr-latest",
+            document=DocumentURLChunk(document_url=signed.url),
+            include_image_base64=include_images,
+        )
+    finally:
+        # Don't leave uploaded PDFs behind in the account's file storage
+        try:
+            client.files.delete(file_id=uploaded.id)
+        except Exception:
+            pass
+
+
+_IMAGE_MAGIC = (
+    (b"\x89PNG", "image/png"),
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"GIF8", "image/gif"),
+)
+
+
+def image_mime(b64: str) -> str:
+    """Sniff the image type from the first few decoded bytes; defaults to PNG."""
+    try:
+        head = b64decode(b64[:16])
+    except ValueError:
+        # binascii.Error, e.g. a short string with incomplete padding
+        return "image/png"
+    for magic, mime in _IMAGE_MAGIC:
+        if head.startswith(magic):
+            return mime
+    return "image/png"
+
+
+def image_data_uri(b64: str) -> str:
+    # Some API versions already return a complete data URI
+    if b64.startswith("data:"):
+        return b64
+    return f"data:{image_mime(b64)};base64,{b64}"
+
+
+_MD_PAGE_HEADER = "\n\n---\n\n### Page "
+_MD_IMAGES_HEADER = "\n\n#### Extracted images\n"
+
+
+def _blake2b_hex(data: bytes) -> str:
+    return hashlib.blake2b(data).hexdigest()
+
+
+# Keyed on the PDF's BLAKE2b digest; underscore-prefixed arguments are excluded from
+# Streamlit's cache key. The cache is process-wide and entries can hold hundreds of MB
+# of image data, so keep it small and short-lived. Markdown and DOCX are rebuilt from it.
+@st.cache_data(show_spinner=False, max_entries=2, ttl="1h")
+def cached_ocr(_client: Mistral, _pdf_bytes: bytes, pdf_sha: str, include_images: bool, api_key_hash: str) -> dict:
+    """run_ocr memoized on the PDF digest; returns a plain dict.
+
+    Pass a hash of the API key, not the key, so results aren't shared across keys.
+    """
+    return run_ocr(_client, _pdf_bytes, include_images).model_dump()
 
 
 def response_to_markdown(resp) -> str:
     """Join page markdown; append extracted images as embedded data URIs per page."""
     md_parts = []
+    # Bound methods hoisted out of the per-page loop
+    md_parts_append = md_parts.append
+    md_parts_extend = md_parts.extend
     for p in resp.pages:
-        # Page header
-        md_parts.append(f"\n\n---\n\n### Page {p.index + 1}\n\n")
-        # Page text
-        if getattr(p, "markdown", None):
-            md_parts.append(p.markdown)
+        page_no = str(p.index + 1)
+        # Page header and text
+        md_parts_extend((f"{_MD_PAGE_HEADER}{page_no}\n\n", p.markdown or ""))
         # Images (if included)
-        images = getattr(p, "images", []) or []
+        images = p.images or []
         if images:
-            md_parts.append("\n\n#### Extracted images\n")
-            for i, im in enumerate(images, start=1):
-                b64 = getattr(im, "image_base64", None)
-                if b64:
-                    # We don't know the exact mime; PNG works for most extracted images
-                    md_parts.append(f"\n![page {p.index+1} image {i}](data:image/png;base64,{b64})\n")
-    return "\n".join(md_parts).strip()
-
-
-def response_to_docx_bytes(resp) -> bytes:
+            md_parts_append(_MD_IMAGES_HEADER)
+            md_parts_extend(
+                f"\n![page {page_no} image {i}]({image_data_uri(b64)})\n"
+                for i, im in enumerate(images, start=1)
+                if (b64 := im.image_base64)
+            )
+    # Parts already carry their own newlines; join without adding separators
+    return "".join(md_parts).strip()
+
+
+def _decode_docx_image(b64: str):
+    """Decode a base64 image and parse its header with python-docx; None if unrecognised."""
+    if b64.startswith("data:"):
+        b64 = b64.partition(",")[2]
+    try:
+        return DocxImage.from_blob(b64decode(b64))
+    except Exception:
+        return None
+
+
+def _add_docx_text(doc, text: str) -> None:
+    """Append one plain paragraph per line, building the ``w:p`` XML directly.
+
+    Equivalent to calling ``doc.add_paragraph(line)`` per line without the
+    Paragraph/Run proxy objects; all paragraphs go in with one slice insert.
+    """
+    paragraphs = []
+    for line in text.splitlines():
+        p = OxmlElement("w:p")
+        if line:
+            r = OxmlElement("w:r")
+            # Tabs become <w:tab/> elements, as python-docx's run text setter does
+            for i, piece in enumerate(line.split("\t")):
+                if i:
+                    r.append(OxmlElement("w:tab"))
+                if piece:
+                    t = OxmlElement("w:t")
+                    t.text = piece
+                    if piece[0].isspace() or piece[-1].isspace():
+                        t.set(qn("xml:space"), "preserve")
+                    r.append(t)
+            p.append(r)
+        paragraphs.append(p)
+    body = doc.element.body
+    # Body content must stay ahead of the trailing section properties
+    sect_pr = body.sectPr
+    idx = body.index(sect_pr) if sect_pr is not None else len(body)
+    body[idx:idx] = paragraphs
+
+
+def _add_docx_picture(doc, image, width) -> None:
+    """Append an already-parsed image in its own paragraph.
+
+    Same result as ``doc.add_picture`` but skips its SHA1 de-duplication, which
+    re-hashes every image already in the document (quadratic in image count).
+    OCR images are distinct, so each one gets its own part. Falls back to the
+    public API if these python-docx internals change.
+    """
+    try:
+        package = doc.part.package
+        partname = PackURI(f"/word/media/image{len(package.image_parts) + 1}.{image.ext}")
+        image_part = ImagePart.from_image(image, partname)
+        package.image_parts.append(image_part)
+        rId = doc.part.relate_to(image_part, RT.IMAGE)
+        cx, cy = image.scaled_dimensions(width, None)
+        inline = CT_Inline.new_pic_inline(doc.part.next_id, rId, image.filename, cx, cy)
+        doc.add_paragraph().add_run()._r.add_drawing(inline)
+    except (AttributeError, TypeError):
+        doc.add_picture(io.BytesIO(image.blob), width=width)
+
+
+def response_to_docx_bytes(resp) -> tuple[bytes, int]:
+    """Build the DOCX; returns its bytes and the number of images that couldn't be embedded."""
     if not HAS_PYTHON_DOCX:
         raise RuntimeError("python-docx is not installed. Run: pip install python-docx")
+    # Decode and parse all images up front on a thread pool (base64 decoding releases the GIL)
+    tasks = [
+        (p_idx, im_idx, b64)
+        for p_idx, p in enumerate(resp.pages)
+        for im_idx, im in enumerate(p.images or [])
+        if (b64 := im.image_base64)
+    ]
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as ex:
+        decoded = dict(ex.map(
+            lambda t: ((t[0], t[1]), _decode_docx_image(t[2])),
+            tasks,
+        ))
+
     doc = DocxDocument()
-    for p in resp.pages:
+    for p_idx, p in enumerate(resp.pages):
         doc.add_heading(f"Page {p.index + 1}", level=2)
-        if getattr(p, "markdown", None):
+        if p.markdown:
             # DOCX doesn't support Markdown; add as plain paragraphs (simple approach)
-            for line in p.markdown.splitlines():
-                doc.add_paragraph(line)
-        images = getattr(p, "images", []) or []
-        for im in images:
-            b64 = getattr(im, "image_base64", None)
-            if b64:
-                bio = io.BytesIO(base64.b64decode(b64))
-                try:
-                    doc.add_picture(bio, width=Inches(6))
-                except Exception:
-                    # Fallback without resizing if pillow can't infer dimensions
-                    bio.seek(0)
-                    doc.add_picture(bio)
+            _add_docx_text(doc, p.markdown)
+        images = p.images or []
+        for im_idx in range(len(images)):
+            image = decoded.get((p_idx, im_idx))
+            if image is not None:
+                _add_docx_picture(doc, image, Inches(6))
         # Page break between pages
         doc.add_page_break()
     out = io.BytesIO()
     doc.save(out)
-    return out.getvalue()
+    skipped = sum(image is None for image in decoded.values())
+    return out.getvalue(), skipped
 
 
 # -----------------------------
 # UI
 # -----------------------------
+# Only this many characters of Markdown are sent to the browser for the preview;
+# the download always has the full document.
+MD_PREVIEW_CHARS = 200_000
+
+
+def markdown_preview(md: str) -> str:
+    """Cut Markdown to MD_PREVIEW_CHARS at a page or image boundary.
+
+    A plain slice can land inside an image's data URI and leave raw base64 in the preview.
+    """
+    if len(md) <= MD_PREVIEW_CHARS:
+        return md
+    cut = max(
+        md.rfind(_MD_PAGE_HEADER, 0, MD_PREVIEW_CHARS),
+        md.rfind("\n![", 0, MD_PREVIEW_CHARS),
+    )
+    return md[:cut] if cut > 0 else md[:MD_PREVIEW_CHARS]
+
+DOCX_MIME = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+
+
+@st.fragment(run_every=1.0)
+def docx_progress():
+    """Poll the background DOCX build; rerun the whole app once it has finished."""
+    fut = st.session_state.get('docx_future')
+    if fut is None:
+        return
+    if not fut.done():
+        st.caption("⏳ Building Word document...")
+        return
+    del st.session_state.docx_future
+    try:
+        st.session_state.docx_bytes, st.session_state.docx_skipped = fut.result()
+    except Exception as e:
+        st.session_state.docx_error = e
+    st.rerun()
+
+
 # --- Page config ---
 st.set_page_config(
     page_title="PDF → Markdown / DOCX", 
@@ -143,9 +341,17 @@ with col2:
     if 'md' in st.session_state:
         # Show download buttons if conversion is done
         st.subheader("Conversion Complete!")
-        st.download_button("Download Markdown (.md)", data=st.session_state.md.encode("utf-8"), file_name="ocr_output.md", mime="text/markdown")
+        st.download_button("Download Markdown (.md)", data=st.session_state.md_bytes, file_name="ocr_output.md", mime="text/markdown")
         if st.session_state.get('docx_bytes'):
-            st.download_button("Download Word (.docx)", data=st.session_state.docx_bytes, file_name="ocr_output.docx", mime="application/vnd.openxmlformats-officedocument.wordprocessingml.document")
+            st.download_button("Download Word (.docx)", data=st.session_state.docx_bytes, file_name="ocr_output.docx", mime=DOCX_MIME)
+            if st.session_state.get('docx_skipped'):
+                st.caption(f"⚠️ {st.session_state.docx_skipped} image(s) were in an unrecognised format and left out of the Word file.")
+        elif 'docx_future' in st.session_state:
+            # DOCX is still being built in the background; Markdown is usable already
+            docx_progress()
+        elif 'docx_error' in st.session_state:
+            st.error("An unexpected error occurred while building the Word document.")
+            st.exception(st.session_state.docx_error)
 
     # Placeholder for the main content
     main_content_placeholder = st.empty()
@@ -182,6 +388,8 @@ The extracted text will appear here once processing completes, ready to use.
         with main_content_placeholder:
             st.subheader("Preview (Markdown)")
             st.markdown(st.session_state.md, unsafe_allow_html=True)
+            if st.session_state.get('md_truncated'):
+                st.caption("Preview truncated; download the Markdown file for the full document.")
 
 # --- Conversion Logic (runs after button click) ---
 if run:
@@ -204,51 +412,63 @@ if run:
         # Clear previous state
         if 'md' in st.session_state:
             del st.session_state.md
-        if 'docx_bytes' in st.session_state:
-            del st.session_state.docx_bytes
+        if 'md_bytes' in st.session_state:
+            del st.session_state.md_bytes
+        for key in ('docx_bytes', 'docx_skipped', 'docx_future', 'docx_error'):
+            if key in st.session_state:
+                del st.session_state[key]
 
         # Client
-        client = Mistral(api_key=api_key)
+        client = get_client(api_key)
 
-        # Progress animation while the request runs in a separate thread
+        # Progress animation while the request runs on the background pool
+        status = st.status("Processing your PDF with Mistral OCR...", expanded=False)
         progress = st.progress(0)
-        status = st.empty()
-
-        def _task():
-            return run_ocr(client, pdf_bytes)
-
-        with ThreadPoolExecutor(max_workers=1) as ex:
-            fut = ex.submit(_task)
-            pct = 0
-            while not fut.done():
-                pct = (pct + 3) % 100
-                progress.progress(pct / 100)
-                status.info("Processing your PDF with Mistral OCR...")
-                time.sleep(0.08)
-            try:
-                resp = fut.result()
-            except Exception as e:
-                progress.empty()
-                status.empty()
-                st.error("An unexpected error occurred while calling Mistral OCR.")
-                st.exception(e)
-                # Keep running to show the footer
-            
+
+        # Images are only needed for DOCX; skipping them cuts the response by ~a third
+        include_images = want_docx and HAS_PYTHON_DOCX
+        pdf_sha = _blake2b_hex(pdf_bytes)
+        api_key_hash = _blake2b_hex(api_key.encode("utf-8"))
+        fut = get_executor().submit(cached_ocr, client, pdf_bytes, pdf_sha, include_images, api_key_hash)
+        done_evt = threading.Event()
+        fut.add_done_callback(lambda _f: done_evt.set())
+        pct = 0
+        while not done_evt.wait(0.5):
+            pct = (pct + 10) % 100
+            progress.progress(pct / 100)
+        resp_dict = None
+        try:
+            resp_dict = fut.result()
+        except Exception as e:
+            progress.empty()
+            status.update(label="OCR failed", state="error")
+            st.error("An unexpected error occurred while calling Mistral OCR.")
+            st.exception(e)
+            # Keep running to show the footer
+
+    if is_ready_to_run and resp_dict is not None:
         # Finish progress
         progress.progress(1.0)
-        status.success("Done! Rendering results...")
+        status.update(label="Done! Rendering results...", state="complete")
 
-        # Compose Markdown and store it
+        # Compose Markdown; keep the encoded bytes for download and a capped slice for preview
+        resp = OCRResponse.model_validate(resp_dict)
         md = response_to_markdown(resp)
-        st.session_state.md = md
+        st.session_state.md_bytes = md.encode("utf-8")
+        st.session_state.md = markdown_preview(md)
+        st.session_state.md_truncated = len(md) > MD_PREVIEW_CHARS
+        del md
 
-        # Generate DOCX and store it if requested
+        # Build DOCX in the background if requested; the download appears when it's ready
         if want_docx:
             if not HAS_PYTHON_DOCX:
                 st.error("`python-docx` is not installed. Run: `pip install python-docx`")
             else:
-                docx_bytes = response_to_docx_bytes(resp)
-                st.session_state.docx_bytes = docx_bytes
+                st.session_state.docx_future = get_executor().submit(response_to_docx_bytes, resp)
+
+        # Drop the script's references to the OCR payload; a pending DOCX build keeps
+        # its own reference until it finishes
+        del resp_dict, resp, fut
         
         # Re-run to update the UI
         st.rerun()